@@ -1,24 +1,104 @@
 import eventlet
 eventlet.monkey_patch()
+from eventlet import tpool
 
+import logging
 import os
+import time
+from collections import deque
+from functools import lru_cache
+import orjson
+import requests
 import tweepy
 from flask import Flask
 from flask_socketio import SocketIO
-from sudachipy import tokenizer
-from sudachipy import dictionary
+from fugashi import Tagger
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # 環境変数からトークンを取得
 BEARER_TOKEN = os.getenv('BEARER_TOKEN')
-client = tweepy.Client(bearer_token=BEARER_TOKEN)
+# レート制限ヘッダを読むため、レスポンスは requests.Response のまま受け取る
+client = tweepy.Client(bearer_token=BEARER_TOKEN, return_type=requests.Response)
+
+QUERY = "祈り OR 共鳴 OR 平和 lang:ja -is:retweet"
+MAX_PAGES_PER_POLL = 3
+# レート制限ヘッダがないときの取得間隔と、ヘッダから決める間隔の下限（1秒1リクエスト）
+POLL_INTERVAL = 60
+MIN_REQUEST_INTERVAL = 1
+# 失敗が続くときは指数バックオフ（最大 2**7 = 128 秒）
+MAX_BACKOFF_EXPONENT = 7
+
+def rate_limit_wait(headers, requests_used=1):
+    """残りのリクエスト数を窓のリセットまで均等に使うための待ち時間を返す"""
+    remaining = headers.get("x-rate-limit-remaining")
+    reset = headers.get("x-rate-limit-reset")
+    if remaining is None or reset is None:
+        return POLL_INTERVAL
+    until_reset = max(0, int(reset) - time.time())
+    wait = min(until_reset / max(int(remaining), 1) * requests_used, until_reset)
+    return max(MIN_REQUEST_INTERVAL, wait)
+
+# Socket.IO の JSON 変換に orjson を使う（標準 json と同じ dumps/loads の形）
+class OrjsonSerializer:
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
 
 # Flask アプリと Socket.IO 初期化
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# eventlet 前提・WebSocket のみ（ロングポーリングへのフォールバックを使わない）
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode="eventlet",
+    ping_interval=25,
+    ping_timeout=60,
+    transports=["websocket"],
+    json=OrjsonSerializer,
+)
 
-# SudachiPy のトークナイザー準備
-tokenizer_obj = dictionary.Dictionary().create()
-mode = tokenizer.Tokenizer.SplitMode.C
+# MeCab (fugashi + UniDic) のトークナイザー準備
+ALLOWED_POS = frozenset(('名詞', '形容詞'))
+tagger = Tagger()
+
+# 同じ本文の再解析を避けるため、(表層形, 品詞) の組をキャッシュ
+@lru_cache(maxsize=4096)
+def tokenize_cached(text):
+    # 解析できない本文（不正なサロゲートなど）はその1件だけ読み飛ばす
+    try:
+        return tuple((node.surface, node.feature.pos1) for node in tagger(text))
+    except Exception as e:
+        logger.error("❌ 解析エラー: %s", e)
+        return ()
+
+# 処理済みツイートID（取得結果が重なっても同じツイートを二度処理しない）
+SEEN_TWEETS_SIZE = 2048
+seen_ids = deque(maxlen=SEEN_TWEETS_SIZE)
+seen_id_set = set()
+
+def unseen(tweets, tweet_id):
+    """未処理のツイートだけを、同じ取得結果内の重複も除いて返す"""
+    fresh = {}
+    for tweet in tweets:
+        if tweet_id(tweet) not in seen_id_set:
+            fresh.setdefault(tweet_id(tweet), tweet)
+    return list(fresh.values())
+
+def mark_seen(tweet_ids):
+    """送信まで済んだツイートIDを記録する（失敗時は次回に再処理される）"""
+    for tweet_id in tweet_ids:
+        if tweet_id in seen_id_set:
+            continue
+        if len(seen_ids) == seen_ids.maxlen:
+            seen_id_set.discard(seen_ids[0])
+        seen_ids.append(tweet_id)
+        seen_id_set.add(tweet_id)
 
 @app.route('/')
 def index():
@@ -26,29 +106,67 @@ def index():
 
 # ツイートを取得して単語を送信
 def fetch_and_push_words():
-    query = "祈り OR 共鳴 OR 平和 lang:ja -is:retweet"
+    since_id = None
+    failures = 0
     while True:
+        started = time.monotonic()
         try:
-            response = client.search_recent_tweets(query=query, max_results=10)
-            if response.data:
-                print(f"🌀 ツイート取得: {len(response.data)} 件")
-                for tweet in response.data:
-                    text = tweet.text
-                    tokens = tokenizer_obj.tokenize(text, mode)
-                    for m in tokens:
-                        if m.part_of_speech()[0] in ['名詞', '形容詞']:
-                            word = m.surface()
-                            print(f"🔁 送信: {word}")
-                            socketio.emit("new_word", word)
+            # 前回取得分より新しいツイートだけをページングして取得
+            paginator = tweepy.Paginator(
+                client.search_recent_tweets,
+                query=QUERY,
+                max_results=100,
+                since_id=since_id,
+                limit=MAX_PAGES_PER_POLL,
+            )
+            tweets = []
+            pages = 0
+            for response in paginator:
+                pages += 1
+                tweets.extend(response.json().get("data", []))
+            # 最後のページのヘッダをもとに、使ったリクエスト数ぶん間隔をあける
+            wait = rate_limit_wait(response.headers, pages)
+            if tweets:
+                newest_id = max(int(tweet["id"]) for tweet in tweets)
+                logger.info("🌀 ツイート取得: %d 件", len(tweets))
+                tweets = unseen(tweets, lambda tweet: tweet["id"])
+                texts = [tweet["text"] for tweet in tweets]
+                # 形態素解析は CPU を使うので OS スレッドで実行し、eventlet のハブを止めない
+                batch = tpool.execute(lambda: [tokenize_cached(text) for text in texts])
+                # 1回の取得分の単語をまとめて1イベントで送信
+                words = [
+                    word
+                    for tokens in batch
+                    for word, pos in tokens
+                    if pos in ALLOWED_POS
+                ]
+                if words:
+                    logger.debug("🔁 送信: %d 語", len(words))
+                    socketio.emit("new_words", words)
+                # 解析と送信が済んでから処理済みにする
+                mark_seen(tweet["id"] for tweet in tweets)
+                since_id = newest_id
+            failures = 0
+        except tweepy.TooManyRequests as e:
+            # レート制限中はリセット時刻まで待つ
+            reset = int(e.response.headers.get("x-rate-limit-reset", 0))
+            logger.warning("⏳ レート制限: %s まで待機", reset)
+            wait = max(0, reset - time.time())
         except Exception as e:
-            print(f"❌ エラー: {e}")
-        socketio.sleep(120)  # 2分ごとに実行
+            logger.error("❌ エラー: %s", e)
+            failures = min(failures + 1, MAX_BACKOFF_EXPONENT)
+            wait = 2 ** failures
+        socketio.sleep(max(0, wait - (time.monotonic() - started)))
+
+# クライアント接続時にバックグラウンドタスク開始（取得ループは1本だけ）
+fetch_task = None
 
-# クライアント接続時にバックグラウンドタスク開始
 @socketio.on('connect')
 def handle_connect():
-    print("✅ クライアント接続")
-    socketio.start_background_task(fetch_and_push_words)
+    global fetch_task
+    logger.info("✅ クライアント接続")
+    if fetch_task is None:
+        fetch_task = socketio.start_background_task(fetch_and_push_words)
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
@@ -1,12 +1,31 @@
+import eventlet
+eventlet.monkey_patch()
+
+import logging
 import os
 import time
+import orjson
 import requests
+from collections import deque
+from requests.adapters import HTTPAdapter
 from flask import Flask
 from flask_socketio import SocketIO
-from threading import Thread
+
+# Socket.IO の JSON 変換に orjson を使う（標準 json と同じ dumps/loads の形）
+class OrjsonSerializer:
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins='*')
+socketio = SocketIO(app, cors_allowed_origins='*', json=OrjsonSerializer)
 
 BEARER_TOKEN = os.getenv("BEARER_TOKEN")
 if not BEARER_TOKEN:
@@ -14,37 +33,98 @@ if not BEARER_TOKEN:
 
 SEARCH_URL = "https://api.twitter.com/2/tweets/search/recent"
 QUERY = "lang:ja"
-MAX_RESULTS = 5
+MAX_RESULTS = 10
+# レート制限ヘッダがないときの取得間隔と、ヘッダから決める間隔の下限（1秒1リクエスト）
+POLL_INTERVAL = 60
+MIN_REQUEST_INTERVAL = 1
+# 失敗が続くときは指数バックオフ（最大 2**7 = 128 秒）
+MAX_BACKOFF_EXPONENT = 7
+
+# TLS 接続を使い回すためのセッション
+session = requests.Session()
+session.headers.update({"Authorization": f"Bearer {BEARER_TOKEN}"})
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
-def get_recent_tweets():
-    headers = {"Authorization": f"Bearer {BEARER_TOKEN}"}
+def rate_limit_wait(headers):
+    """残りのリクエスト数を窓のリセットまで均等に使うための待ち時間を返す"""
+    remaining = headers.get("x-rate-limit-remaining")
+    reset = headers.get("x-rate-limit-reset")
+    if remaining is None or reset is None:
+        return POLL_INTERVAL
+    wait = max(0, int(reset) - time.time()) / max(int(remaining), 1)
+    return max(MIN_REQUEST_INTERVAL, wait)
+
+def get_recent_tweets(since_id=None):
+    """ツイートと、このリクエストから次のリクエストまで待つべき秒数を返す"""
     params = {
         "query": QUERY,
         "max_results": MAX_RESULTS
     }
+    if since_id:
+        params["since_id"] = since_id
     try:
-        response = requests.get(SEARCH_URL, headers=headers, params=params)
+        response = session.get(SEARCH_URL, params=params)
         if response.status_code == 200:
-            return response.json()
+            return response.json(), rate_limit_wait(response.headers)
+        elif response.status_code == 429:
+            # レート制限中はリセット時刻まで待つ
+            reset = int(response.headers.get("x-rate-limit-reset", 0))
+            logger.warning("Rate limited until: %s", reset)
+            return None, max(0, reset - time.time())
         else:
-            print("API error:", response.status_code)
+            logger.error("API error: %s", response.status_code)
     except Exception as e:
-        print("Request failed:", str(e))
-    return None
+        logger.error("Request failed: %s", e)
+    return None, 0
+
+# 処理済みツイートID（取得結果が重なっても同じツイートを二度処理しない）
+SEEN_TWEETS_SIZE = 2048
+seen_ids = deque(maxlen=SEEN_TWEETS_SIZE)
+seen_id_set = set()
+
+def unseen(tweets, tweet_id):
+    """未処理のツイートだけを、同じ取得結果内の重複も除いて返す"""
+    fresh = {}
+    for tweet in tweets:
+        if tweet_id(tweet) not in seen_id_set:
+            fresh.setdefault(tweet_id(tweet), tweet)
+    return list(fresh.values())
+
+def mark_seen(tweet_ids):
+    """送信まで済んだツイートIDを記録する（失敗時は次回に再処理される）"""
+    for tweet_id in tweet_ids:
+        if tweet_id in seen_id_set:
+            continue
+        if len(seen_ids) == seen_ids.maxlen:
+            seen_id_set.discard(seen_ids[0])
+        seen_ids.append(tweet_id)
+        seen_id_set.add(tweet_id)
 
 def tweet_loop():
+    since_id = None
+    failures = 0
     while True:
-        data = get_recent_tweets()
+        started = time.monotonic()
+        data, wait = get_recent_tweets(since_id)
+        if data is None:
+            failures = min(failures + 1, MAX_BACKOFF_EXPONENT)
+            wait = max(wait, 2 ** failures)
+        else:
+            failures = 0
         if data and "data" in data:
-            for tweet in data["data"]:
-                text = tweet["text"]
-                socketio.emit("new-word", {"word": text})
-        time.sleep(60)
+            tweets = unseen(data["data"], lambda tweet: tweet["id"])
+            words = [tweet["text"] for tweet in tweets]
+            if words:
+                socketio.emit("new-words", {"words": words})
+            # 送信が済んでから処理済みにする
+            mark_seen(tweet["id"] for tweet in tweets)
+            since_id = data["meta"]["newest_id"]
+        socketio.sleep(max(0, wait - (time.monotonic() - started)))
 
 @app.route('/')
 def index():
     return "KYOMEI JINJA - Minimal Server is running."
 
 if __name__ == "__main__":
-    Thread(target=tweet_loop, daemon=True).start()
+    socketio.start_background_task(tweet_loop)
     socketio.run(app, host="0.0.0.0", port=5000)